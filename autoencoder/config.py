@@ -1,5 +1,6 @@
 
 BATCH = 128  # B
+NUM_WORKERS = 4
 
 TRIALS = 5
 
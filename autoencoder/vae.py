@@ -1,7 +1,9 @@
 import os
+import sys
 import random
 
 import torch
+import torch._inductor.config
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader
@@ -15,70 +17,94 @@ from models.vae import VAE
 from config import *
 from transform import Cifar
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from data.prefetcher import Prefetcher
 
-random.seed('KMU_AELAB')
-torch.manual_seed(0)
-torch.backends.cudnn.deterministic = True
 
+DETERMINISTIC = os.environ.get('DETERMINISTIC', '0') == '1'
 
-transforms = Cifar()
+LOADER_KWARGS = {'pin_memory': True, 'num_workers': NUM_WORKERS,
+                 'persistent_workers': NUM_WORKERS > 0, 'prefetch_factor': 4 if NUM_WORKERS > 0 else None}
 
-if DATASET == 'cifar10':
-    data_train = CIFAR10('../data', train=True, download=True, transform=transforms.transform)
-    data_unlabeled = CIFAR10('../data', train=True, download=True, transform=transforms.transform)
-    data_test = CIFAR10('../data', train=False, download=True, transform=transforms.transform)
-elif DATASET == 'cifar100':
-    data_train = CIFAR100('../data', train=True, download=True, transform=transforms.transform)
-    data_unlabeled = CIFAR100('../data', train=True, download=True, transform=transforms.transform)
-    data_test = CIFAR100('../data', train=False, download=True, transform=transforms.transform)
 
+def build_datasets():
+    transforms = Cifar()
 
-def train_epoch(model, criterion, opt, dataloaders, summary_writer, epoch):
+    if DATASET == 'cifar10':
+        data_train = CIFAR10('../data', train=True, download=True, transform=transforms.transform)
+        data_unlabeled = CIFAR10('../data', train=True, download=True, transform=transforms.transform)
+        data_test = CIFAR10('../data', train=False, download=True, transform=transforms.transform)
+    elif DATASET == 'cifar100':
+        data_train = CIFAR100('../data', train=True, download=True, transform=transforms.transform)
+        data_unlabeled = CIFAR100('../data', train=True, download=True, transform=transforms.transform)
+        data_test = CIFAR100('../data', train=False, download=True, transform=transforms.transform)
+
+    return data_train, data_unlabeled, data_test
+
+
+@torch.compile
+def kl_divergence(mu, logvar):
+    return -0.5 * (1 + logvar - mu.square() - logvar.exp()).sum()
+
+
+def train_epoch(model, criterion, opt, dataloaders, summary_writer, epoch, amp_dtype, scaler):
     model.train()
 
     cnt = 0
-    _loss = 0.
-    for data in tqdm(dataloaders['train'], leave=False, total=len(dataloaders['train'])):
+    _loss = torch.zeros((), device='cuda')
+    for inputs, _ in tqdm(Prefetcher(dataloaders['train']), leave=False):
         cnt += 1
 
         opt.zero_grad()
-        inputs = data[0].cuda()
-        targets = data[1].cuda()
 
-        recon, features, mu, logvar = model(inputs)
+        with torch.autocast('cuda', dtype=amp_dtype):
+            recon, _, mu, logvar = model(inputs)
+
+        # sum-reduced losses are kept in fp32
+        recon, mu, logvar = recon.float(), mu.float(), logvar.float()
         recon_loss = criterion(recon, inputs)
-        kld_loss = torch.sum(-0.5 * torch.sum(1 + logvar - mu ** 2 - logvar.exp(), dim=1), dim=0)
+        kld_loss = kl_divergence(mu, logvar)
 
         loss = recon_loss + kld_loss
 
-        loss.backward()
-        opt.step()
+        scaler.scale(loss).backward()
+        scaler.step(opt)
+        scaler.update()
 
-        _loss += loss
+        _loss += loss.detach()
 
-    summary_writer.add_image('image/origin', inputs[0], epoch)
-    summary_writer.add_image('image/recon', recon[0], epoch)
-    summary_writer.add_scalar('loss', _loss / cnt, epoch)
+    _loss = _loss.item() / cnt
 
-    if epoch % 100 == 99:
-        summary_writer.add_embedding(features.detach(), metadata=targets.detach().cpu().numpy(),
-                                     label_img=inputs.detach(), global_step=epoch)
+    if epoch % 10 == 0:
+        summary_writer.add_image('image/origin', inputs[0], epoch)
+        summary_writer.add_image('image/recon', recon[0], epoch)
+    summary_writer.add_scalar('loss', _loss, epoch)
 
-    return _loss / cnt
+    return _loss
 
 
-def test(model, criterion, dataloaders, mode='val'):
+def test(model, criterion, dataloaders, mode='val', summary_writer=None, epoch=None):
     assert mode == 'val' or mode == 'test'
     model.eval()
 
+    log_embedding = summary_writer is not None and epoch % 100 == 99
+
     loss = 0.
     with torch.no_grad():
-        for (inputs, _) in dataloaders[mode]:
-            inputs = inputs.cuda()
+        for i, (inputs, targets) in enumerate(dataloaders[mode]):
+            inputs = inputs.cuda(non_blocking=True)
 
-            recon, _, _, _ = model(inputs)
+            recon, features, _, _ = model(inputs)
             loss += criterion(recon, inputs)
 
+            if log_embedding and i == 0:
+                embedding = (features.clone(), targets, inputs)
+
+    if log_embedding:
+        features, targets, inputs = embedding
+        summary_writer.add_embedding(features.cpu(), metadata=targets.numpy(),
+                                     label_img=inputs.cpu(), global_step=epoch)
+
     return loss
 
 
@@ -89,13 +115,16 @@ def train(model, criterion, opt, scheduler, dataloaders, num_epochs):
     summary_writer = SummaryWriter(log_dir=os.path.join('./'), comment='VAE')
     if not os.path.exists('../trained_ae'):
         os.makedirs('../trained_ae')
-    
+
+    amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported(including_emulation=False) else torch.float16
+    scaler = torch.amp.GradScaler('cuda', enabled=amp_dtype == torch.float16)
+
     for epoch in range(num_epochs):
-        loss = train_epoch(model, criterion, opt, dataloaders, summary_writer, epoch)
+        loss = train_epoch(model, criterion, opt, dataloaders, summary_writer, epoch, amp_dtype, scaler)
         scheduler.step(loss)
 
         if epoch % 5 == 4:
-            _loss = test(model, criterion, dataloaders, 'test')
+            _loss = test(model, criterion, dataloaders, 'test', summary_writer, epoch)
             if best_loss > _loss:
                 best_loss = _loss
                 torch.save(
@@ -110,16 +139,26 @@ def train(model, criterion, opt, scheduler, dataloaders, num_epochs):
 
 
 if __name__ == '__main__':
-    train_loader = DataLoader(data_train, batch_size=BATCH, pin_memory=True)
-    test_loader = DataLoader(data_test, batch_size=BATCH)
+    random.seed('KMU_AELAB')
+    torch.manual_seed(0)
+    torch.backends.cudnn.deterministic = DETERMINISTIC
+
+    data_train, data_unlabeled, data_test = build_datasets()
+
+    train_loader = DataLoader(data_train, batch_size=BATCH, drop_last=True, **LOADER_KWARGS)
+    test_loader = DataLoader(data_test, batch_size=BATCH, **LOADER_KWARGS)
     dataloaders = {'train': train_loader, 'test': test_loader}
 
     # Model
     model = VAE(NUM_RESIDUAL_LAYERS, NUM_RESIDUAL_HIDDENS, EMBEDDING_DIM).cuda()
-    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.benchmark = not DETERMINISTIC
+
+    # compiled in place so state_dict keys stay unprefixed; reduce-overhead replays CUDA graphs
+    torch._inductor.config.triton.cudagraph_skip_dynamic_graphs = True
+    model.compile(mode='reduce-overhead')
 
     criterion = nn.MSELoss(reduction='sum').cuda()
-    opt = optim.Adam(model.parameters(), lr=LR)
+    opt = optim.Adam(model.parameters(), lr=LR, fused=True)
 
     scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(opt, mode='min', factor=0.8, cooldown=4)
 
@@ -4,8 +4,9 @@ import random
 from collections import Counter
 
 import torch
-import numpy as np
+import torch._inductor.config
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 from torch.utils.data import DataLoader
 import torch.optim.lr_scheduler as lr_scheduler
@@ -20,78 +21,76 @@ from models.resnet import ResNet18
 from models.lossnet import LossNet
 from data.transform import Cifar
 from data.sampler import SubsetSequentialSampler
+from data.prefetcher import Prefetcher
 
 
-random.seed('KMU_AELAB')
-torch.manual_seed(0)
-torch.backends.cudnn.deterministic = True
+DETERMINISTIC = os.environ.get('DETERMINISTIC', '0') == '1'
 
+LOADER_KWARGS = {'pin_memory': True, 'num_workers': NUM_WORKERS,
+                 'persistent_workers': NUM_WORKERS > 0, 'prefetch_factor': 4 if NUM_WORKERS > 0 else None}
 
-transforms = Cifar()
 
+def build_datasets():
+    transforms = Cifar()
 
-if DATASET == 'cifar10':
-    data_train = CIFAR10('./data', train=True, download=True, transform=transforms.train_transform)
-    data_unlabeled = CIFAR10('./data', train=True, download=True, transform=transforms.test_transform)
-    data_test = CIFAR10('./data', train=False, download=True, transform=transforms.test_transform)
-elif DATASET == 'cifar100':
-    data_train = CIFAR100('./data', train=True, download=True, transform=transforms.train_transform)
-    data_unlabeled = CIFAR100('./data', train=True, download=True, transform=transforms.test_transform)
-    data_test = CIFAR100('./data', train=False, download=True, transform=transforms.test_transform)
-else:
-    raise FileExistsError
+    if DATASET == 'cifar10':
+        data_train = CIFAR10('./data', train=True, download=True, transform=transforms.train_transform)
+        data_unlabeled = CIFAR10('./data', train=True, download=True, transform=transforms.test_transform)
+        data_test = CIFAR10('./data', train=False, download=True, transform=transforms.test_transform)
+    elif DATASET == 'cifar100':
+        data_train = CIFAR100('./data', train=True, download=True, transform=transforms.train_transform)
+        data_unlabeled = CIFAR100('./data', train=True, download=True, transform=transforms.test_transform)
+        data_test = CIFAR100('./data', train=False, download=True, transform=transforms.test_transform)
+    else:
+        raise FileExistsError
+
+    return data_train, data_unlabeled, data_test
 
 
 def loss_pred_loss(input, target, margin=1.0, reduction='mean'):
     assert len(input) % 2 == 0, 'the batch size is not even.'
-    assert input.shape == input.flip(0).shape
-    
-    input = (input - input.flip(0))[:len(input)//2]
-    target = (target - target.flip(0))[:len(target)//2]
-    target = target.detach()
 
-    one = 2 * torch.sign(torch.clamp(target, min=0)) - 1
+    n = input.size(0) // 2
+    target = target.detach()
+    one = torch.where(target[:n] > target[n:], 1.0, -1.0)
 
-    if reduction == 'mean':
-        loss = torch.sum(torch.clamp(margin - one * input, min=0))
-        loss = loss / input.size(0)
-    elif reduction == 'none':
-        loss = torch.clamp(margin - one * input, min=0)
-    else:
-        NotImplementedError()
-    
-    return loss
+    return F.margin_ranking_loss(input[:n], input[n:], one, margin=margin, reduction=reduction)
 
 
-def train_epoch(models, criterion, optimizers, dataloaders, epoch, epoch_loss):
+def train_epoch(models, criterion, optimizers, dataloaders, detach_features, amp_dtype, scaler, track_acc=False):
     models['backbone'].train()
     models['module'].train()
 
-    for data in tqdm(dataloaders['train'], leave=False, total=len(dataloaders['train'])):
-        inputs = data[0].cuda()
-        labels = data[1].cuda()
-
+    total = 0
+    correct = torch.zeros((), dtype=torch.long, device='cuda')
+    for inputs, labels in tqdm(Prefetcher(dataloaders['train']), leave=False):
         optimizers['backbone'].zero_grad()
         optimizers['module'].zero_grad()
 
-        scores, features = models['backbone'](inputs)
-        target_loss = criterion(scores, labels)
+        with torch.autocast('cuda', dtype=amp_dtype):
+            scores, features = models['backbone'](inputs)
+            target_loss = criterion(scores, labels)
+
+            if detach_features:
+                features = [f.detach() for f in features]
+            pred_loss = models['module'](features)
+            pred_loss = pred_loss.view(pred_loss.size(0)).float()
+
+            m_backbone_loss = target_loss.mean()
+            m_module_loss = loss_pred_loss(pred_loss, target_loss, margin=MARGIN)
+            loss = m_backbone_loss + WEIGHT * m_module_loss
 
-        if epoch > epoch_loss:
-            features[0] = features[0].detach()
-            features[1] = features[1].detach()
-            features[2] = features[2].detach()
-            features[3] = features[3].detach()
-        pred_loss = models['module'](features)
-        pred_loss = pred_loss.view(pred_loss.size(0))
+        scaler.scale(loss).backward()
+        scaler.step(optimizers['backbone'])
+        scaler.step(optimizers['module'])
+        scaler.update()
 
-        m_backbone_loss = torch.sum(target_loss) / target_loss.size(0)
-        m_module_loss = loss_pred_loss(pred_loss, target_loss, margin=MARGIN)
-        loss = m_backbone_loss + WEIGHT * m_module_loss
+        if track_acc:
+            total += labels.size(0)
+            correct += (scores.argmax(1) == labels).sum()
 
-        loss.backward()
-        optimizers['backbone'].step()
-        optimizers['module'].step()
+    if track_acc:
+        return 100 * correct.item() / total
 
 
 def test(models, dataloaders, mode='val'):
@@ -102,8 +101,8 @@ def test(models, dataloaders, mode='val'):
     correct = 0
     with torch.no_grad():
         for (inputs, labels) in dataloaders[mode]:
-            inputs = inputs.cuda()
-            labels = labels.cuda()
+            inputs = inputs.cuda(non_blocking=True)
+            labels = labels.cuda(non_blocking=True)
 
             scores, _ = models['backbone'](inputs)
             _, preds = torch.max(scores.data, 1)
@@ -119,113 +118,139 @@ def train(models, criterion, optimizers, schedulers, dataloaders, num_epochs, ep
     checkpoint_dir = os.path.join(f'./trained', 'weights')
     if not os.path.exists(checkpoint_dir):
         os.makedirs(checkpoint_dir)
-    
+
+    amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported(including_emulation=False) else torch.float16
+    scaler = torch.amp.GradScaler('cuda', enabled=amp_dtype == torch.float16)
+
+    train_acc = None
     for epoch in range(num_epochs):
         schedulers['backbone'].step()
         schedulers['module'].step()
 
-        train_epoch(models, criterion, optimizers, dataloaders, epoch, epoch_loss)
+        train_acc = train_epoch(models, criterion, optimizers, dataloaders, epoch > epoch_loss, amp_dtype, scaler,
+                                track_acc=epoch == num_epochs - 1)
 
     print('>> Finished.')
 
+    return train_acc
+
 
 def get_uncertainty(models, unlabeled_loader):
     models['backbone'].eval()
     models['module'].eval()
 
-    uncertainty = torch.tensor([]).cuda()
-    label = torch.tensor([], dtype=torch.long).cuda()
+    n = len(unlabeled_loader.sampler)
+    uncertainty = torch.empty(n, device='cuda')
+    label = torch.empty(n, dtype=torch.long, device='cuda')
+    offset = 0
     with torch.no_grad():
         for (inputs, labels) in unlabeled_loader:
-            inputs = inputs.cuda()
-            labels = labels.cuda()
+            inputs = inputs.cuda(non_blocking=True)
+            labels = labels.cuda(non_blocking=True)
 
             scores, features = models['backbone'](inputs)
             pred_loss = models['module'](features)
             pred_loss = pred_loss.view(pred_loss.size(0))
 
-            uncertainty = torch.cat((uncertainty, pred_loss), 0)
-            label = torch.cat((label, labels), 0)
+            bs = inputs.size(0)
+            uncertainty[offset:offset + bs].copy_(pred_loss)
+            label[offset:offset + bs].copy_(labels)
+            offset += bs
 
-    return uncertainty.cpu(), label.cpu()
+    return uncertainty, label
 
 
 def get_real_uncertainty(models, unlabeled_loader, criterion):
     models['backbone'].eval()
     models['module'].eval()
 
-    uncertainty = torch.tensor([]).cuda()
-    label = torch.tensor([], dtype=torch.long).cuda()
+    n = len(unlabeled_loader.sampler)
+    uncertainty = torch.empty(n, device='cuda')
+    label = torch.empty(n, dtype=torch.long, device='cuda')
+    offset = 0
     with torch.no_grad():
         for (inputs, labels) in unlabeled_loader:
-            inputs = inputs.cuda()
-            labels = labels.cuda()
+            inputs = inputs.cuda(non_blocking=True)
+            labels = labels.cuda(non_blocking=True)
 
             scores, features = models['backbone'](inputs)
             target_loss = criterion(scores, labels)
 
-            uncertainty = torch.cat((uncertainty, target_loss), 0)
-            label = torch.cat((label, labels), 0)
+            bs = inputs.size(0)
+            uncertainty[offset:offset + bs].copy_(target_loss)
+            label[offset:offset + bs].copy_(labels)
+            offset += bs
 
-    return uncertainty.cpu(), label.cpu()
+    return uncertainty, label
 
 
 if __name__ == '__main__':
+    random.seed('KMU_AELAB')
+    torch.manual_seed(0)
+    torch.backends.cudnn.deterministic = DETERMINISTIC
+
+    data_train, data_unlabeled, data_test = build_datasets()
+
     indices = list(range(NUM_TRAIN))
     random.shuffle(indices)
     labeled_set = indices[:INIT_CNT]
     unlabeled_set = indices[INIT_CNT:]
 
+    train_sampler = SubsetRandomSampler(labeled_set)
+    unlabeled_sampler = SubsetSequentialSampler([])
+
     train_loader = DataLoader(data_train, batch_size=BATCH,
-                              sampler=SubsetRandomSampler(labeled_set),
-                              pin_memory=True)
-    test_loader = DataLoader(data_test, batch_size=BATCH)
+                              sampler=train_sampler, drop_last=True, **LOADER_KWARGS)
+    test_loader = DataLoader(data_test, batch_size=BATCH, **LOADER_KWARGS)
+    unlabeled_loader = DataLoader(data_unlabeled, batch_size=BATCH,
+                                  sampler=unlabeled_sampler, **LOADER_KWARGS)
     dataloaders = {'train': train_loader, 'test': test_loader}
 
     loss_module = LossNet().cuda()
     resnet18 = ResNet18(num_classes=CLS_CNT).cuda()
     models = {'backbone': resnet18, 'module': loss_module}
+    torch._inductor.config.triton.cudagraph_skip_dynamic_graphs = True
+    for model in models.values():
+        model.compile(mode='reduce-overhead')
 
-    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.benchmark = not DETERMINISTIC
 
-    for cycle in range(CYCLES):
-        criterion = nn.CrossEntropyLoss(reduction='none').cuda()
+    criterion = nn.CrossEntropyLoss(reduction='none').cuda()
 
+    for cycle in range(CYCLES):
         optim_backbone = optim.SGD(models['backbone'].parameters(), lr=LR,
-                                   momentum=MOMENTUM, weight_decay=WDECAY)
+                                   momentum=MOMENTUM, weight_decay=WDECAY, fused=True)
         optim_module = optim.SGD(models['module'].parameters(), lr=LR,
-                                 momentum=MOMENTUM, weight_decay=WDECAY)
+                                 momentum=MOMENTUM, weight_decay=WDECAY, fused=True)
         optimizers = {'backbone': optim_backbone, 'module': optim_module}
 
         sched_backbone = lr_scheduler.MultiStepLR(optim_backbone, milestones=MILESTONES)
         sched_module = lr_scheduler.MultiStepLR(optim_module, milestones=MILESTONES)
         schedulers = {'backbone': sched_backbone, 'module': sched_module}
 
-        train(models, criterion, optimizers, schedulers, dataloaders, EPOCH, EPOCHL)
+        train_acc = train(models, criterion, optimizers, schedulers, dataloaders, EPOCH, EPOCHL)
         acc = test(models, dataloaders, mode='test')
-        train_acc = test(models, dataloaders, mode='train')
 
-        print('Cycle {}/{} || Label set size {}: Test acc {}: Train acc {}'.format(cycle + 1, CYCLES, len(labeled_set),
-                                                                                   acc, train_acc))
+        print('Cycle {}/{} || Label set size {}: Test acc {}: Last-epoch train acc {}'.format(
+            cycle + 1, CYCLES, len(labeled_set), acc, train_acc))
 
         random.shuffle(unlabeled_set)
         subset = unlabeled_set[:]
-
-        unlabeled_loader = DataLoader(data_unlabeled, batch_size=BATCH,
-                                      sampler=SubsetSequentialSampler(subset),
-                                      pin_memory=True)
+        unlabeled_sampler.indices = subset
 
         uncertainty, labels = get_uncertainty(models, unlabeled_loader)
         real_uncertainty, real_labels = get_real_uncertainty(models, unlabeled_loader, criterion)
 
-        arg = np.argsort(uncertainty)
-        selected_labels = list(torch.tensor(labels)[arg][-ADDENDUM:].numpy())
-        selected_samples = list(torch.tensor(subset)[arg][-ADDENDUM:].numpy())
+        subset_t = torch.as_tensor(subset, device=uncertainty.device)
+
+        _, arg = torch.topk(uncertainty, ADDENDUM)
+        selected_labels = labels[arg].tolist()
+        selected_samples = subset_t[arg].tolist()
         selected_label_cnt = Counter(selected_labels)
 
-        real_arg = np.argsort(real_uncertainty)
-        real_labels = list(torch.tensor(real_labels)[real_arg][-5000:].numpy())
-        real_samples = list(torch.tensor(subset)[real_arg][-5000:].numpy())
+        _, real_arg = torch.topk(real_uncertainty, 5000)
+        real_labels = real_labels[real_arg].tolist()
+        real_samples = subset_t[real_arg].tolist()
         real_label_cnt = Counter(real_labels)
 
         with open(f'data_{cycle}.pkl', 'wb') as f:
@@ -233,10 +258,10 @@ if __name__ == '__main__':
                          'real_samples': real_samples, 'real_label_cnt': real_label_cnt}, f)
 
         labeled_set += selected_samples
-        unlabeled_set = list(torch.tensor(subset)[arg][:-ADDENDUM].numpy())
+        unselected = torch.ones_like(subset_t, dtype=torch.bool)
+        unselected[arg] = False
+        unlabeled_set = subset_t[unselected].tolist()
 
         print(len(set(labeled_set)), len(set(unlabeled_set)))
 
-        dataloaders['train'] = DataLoader(data_train, batch_size=BATCH,
-                                          sampler=SubsetRandomSampler(labeled_set),
-                                          pin_memory=True)
+        train_sampler.indices = labeled_set
@@ -1,6 +1,7 @@
 
 NUM_TRAIN = 50000
 BATCH = 128
+NUM_WORKERS = 4
 SUBSET = 10000
 ADDENDUM = 2500
 INIT_CNT = 5000
@@ -0,0 +1,45 @@
+import torch
+
+
+class Prefetcher(object):
+    def __init__(self, loader):
+        self.loader = loader
+        self.iterator = None
+        self.stream = torch.cuda.Stream()
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.next_input = None
+            self.next_target = None
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_input = batch[0].cuda(non_blocking=True)
+            self.next_target = batch[1].cuda(non_blocking=True)
+
+    def next(self):
+        # a pass starts lazily and ends after exactly len(self.loader) batches
+        if self.iterator is None:
+            self.iterator = iter(self.loader)
+            self.preload()
+
+        torch.cuda.current_stream().wait_stream(self.stream)
+        inputs, targets = self.next_input, self.next_target
+        if inputs is None:
+            self.iterator = None
+            return None
+
+        inputs.record_stream(torch.cuda.current_stream())
+        targets.record_stream(torch.cuda.current_stream())
+        self.preload()
+
+        return inputs, targets
+
+    def __iter__(self):
+        while (batch := self.next()) is not None:
+            yield batch
+
+    def __len__(self):
+        return len(self.loader)
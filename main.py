@@ -2,8 +2,10 @@ import os
 import random
 
 import torch
+import torch._inductor.config
 import numpy as np
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 from torch.utils.data import DataLoader
 import torch.optim.lr_scheduler as lr_scheduler
@@ -18,78 +20,67 @@ from models.resnet import ResNet18
 from models.lossnet import LossNet
 from data.transform import Cifar
 from data.sampler import SubsetSequentialSampler
+from data.prefetcher import Prefetcher
 
 
-random.seed('KMU_AELAB')
-torch.manual_seed(0)
-torch.backends.cudnn.deterministic = True
+DETERMINISTIC = os.environ.get('DETERMINISTIC', '0') == '1'
 
+LOADER_KWARGS = {'pin_memory': True, 'num_workers': NUM_WORKERS,
+                 'persistent_workers': NUM_WORKERS > 0, 'prefetch_factor': 4 if NUM_WORKERS > 0 else None}
 
-transforms = Cifar()
 
+def build_datasets():
+    transforms = Cifar()
 
-if DATASET == 'cifar10':
-    data_train = CIFAR10('./data', train=True, download=True, transform=transforms.train_transform)
-    data_unlabeled = CIFAR10('./data', train=True, download=True, transform=transforms.test_transform)
-    data_test = CIFAR10('./data', train=False, download=True, transform=transforms.test_transform)
-elif DATASET == 'cifar100':
-    data_train = CIFAR100('./data', train=True, download=True, transform=transforms.train_transform)
-    data_unlabeled = CIFAR100('./data', train=True, download=True, transform=transforms.test_transform)
-    data_test = CIFAR100('./data', train=False, download=True, transform=transforms.test_transform)
-else:
-    raise FileExistsError
+    if DATASET == 'cifar10':
+        data_train = CIFAR10('./data', train=True, download=True, transform=transforms.train_transform)
+        data_unlabeled = CIFAR10('./data', train=True, download=True, transform=transforms.test_transform)
+        data_test = CIFAR10('./data', train=False, download=True, transform=transforms.test_transform)
+    elif DATASET == 'cifar100':
+        data_train = CIFAR100('./data', train=True, download=True, transform=transforms.train_transform)
+        data_unlabeled = CIFAR100('./data', train=True, download=True, transform=transforms.test_transform)
+        data_test = CIFAR100('./data', train=False, download=True, transform=transforms.test_transform)
+    else:
+        raise FileExistsError
+
+    return data_train, data_unlabeled, data_test
 
 
 def loss_pred_loss(input, target, margin=1.0, reduction='mean'):
     assert len(input) % 2 == 0, 'the batch size is not even.'
-    assert input.shape == input.flip(0).shape
-    
-    input = (input - input.flip(0))[:len(input)//2]
-    target = (target - target.flip(0))[:len(target)//2]
+
+    n = input.size(0) // 2
     target = target.detach()
+    one = torch.where(target[:n] > target[n:], 1.0, -1.0)
 
-    one = 2 * torch.sign(torch.clamp(target, min=0)) - 1
+    return F.margin_ranking_loss(input[:n], input[n:], one, margin=margin, reduction=reduction)
 
-    if reduction == 'mean':
-        loss = torch.sum(torch.clamp(margin - one * input, min=0))
-        loss = loss / input.size(0)
-    elif reduction == 'none':
-        loss = torch.clamp(margin - one * input, min=0)
-    else:
-        NotImplementedError()
-    
-    return loss
 
-
-def train_epoch(models, criterion, optimizers, dataloaders, epoch, epoch_loss):
+def train_epoch(models, criterion, optimizers, dataloaders, detach_features, amp_dtype, scaler):
     models['backbone'].train()
     models['module'].train()
 
-    for data in tqdm(dataloaders['train'], leave=False, total=len(dataloaders['train'])):
-        inputs = data[0].cuda()
-        labels = data[1].cuda()
-
+    for inputs, labels in tqdm(Prefetcher(dataloaders['train']), leave=False):
         optimizers['backbone'].zero_grad()
         optimizers['module'].zero_grad()
 
-        scores, features = models['backbone'](inputs)
-        target_loss = criterion(scores, labels)
+        with torch.autocast('cuda', dtype=amp_dtype):
+            scores, features = models['backbone'](inputs)
+            target_loss = criterion(scores, labels)
 
-        if epoch > epoch_loss:
-            features[0] = features[0].detach()
-            features[1] = features[1].detach()
-            features[2] = features[2].detach()
-            features[3] = features[3].detach()
-        pred_loss = models['module'](features)
-        pred_loss = pred_loss.view(pred_loss.size(0))
+            if detach_features:
+                features = [f.detach() for f in features]
+            pred_loss = models['module'](features)
+            pred_loss = pred_loss.view(pred_loss.size(0)).float()
 
-        m_backbone_loss = torch.sum(target_loss) / target_loss.size(0)
-        m_module_loss = loss_pred_loss(pred_loss, target_loss, margin=MARGIN)
-        loss = m_backbone_loss + WEIGHT * m_module_loss
+            m_backbone_loss = target_loss.mean()
+            m_module_loss = loss_pred_loss(pred_loss, target_loss, margin=MARGIN)
+            loss = m_backbone_loss + WEIGHT * m_module_loss
 
-        loss.backward()
-        optimizers['backbone'].step()
-        optimizers['module'].step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizers['backbone'])
+        scaler.step(optimizers['module'])
+        scaler.update()
 
 
 def test(models, dataloaders, mode='val'):
@@ -100,8 +91,8 @@ def test(models, dataloaders, mode='val'):
     correct = 0
     with torch.no_grad():
         for (inputs, labels) in dataloaders[mode]:
-            inputs = inputs.cuda()
-            labels = labels.cuda()
+            inputs = inputs.cuda(non_blocking=True)
+            labels = labels.cuda(non_blocking=True)
 
             scores, _ = models['backbone'](inputs)
             _, preds = torch.max(scores.data, 1)
@@ -117,12 +108,15 @@ def train(models, criterion, optimizers, schedulers, dataloaders, num_epochs, ep
     checkpoint_dir = os.path.join(f'./trained', 'weights')
     if not os.path.exists(checkpoint_dir):
         os.makedirs(checkpoint_dir)
-    
+
+    amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported(including_emulation=False) else torch.float16
+    scaler = torch.amp.GradScaler('cuda', enabled=amp_dtype == torch.float16)
+
     for epoch in range(num_epochs):
         schedulers['backbone'].step()
         schedulers['module'].step()
 
-        train_epoch(models, criterion, optimizers, dataloaders, epoch, epoch_loss)
+        train_epoch(models, criterion, optimizers, dataloaders, epoch > epoch_loss, amp_dtype, scaler)
 
     print('>> Finished.')
 
@@ -131,23 +125,45 @@ def get_uncertainty(models, unlabeled_loader, criterion):
     models['backbone'].eval()
     models['module'].eval()
 
-    uncertainty = torch.tensor([]).cuda()
-    label = torch.tensor([], dtype=torch.long).cuda()
+    n = len(unlabeled_loader.sampler)
+    uncertainty = torch.empty(n, device='cuda')
+    label = torch.empty(n, dtype=torch.long, device='cuda')
+    offset = 0
     with torch.no_grad():
         for (inputs, labels) in unlabeled_loader:
-            inputs = inputs.cuda()
-            labels = labels.cuda()
+            inputs = inputs.cuda(non_blocking=True)
+            labels = labels.cuda(non_blocking=True)
 
             scores, features = models['backbone'](inputs)
             target_loss = criterion(scores, labels)
 
-            uncertainty = torch.cat((uncertainty, target_loss), 0)
-            label = torch.cat((label, labels), 0)
+            bs = inputs.size(0)
+            uncertainty[offset:offset + bs].copy_(target_loss)
+            label[offset:offset + bs].copy_(labels)
+            offset += bs
     
-    return uncertainty.cpu(), label.cpu()
+    return uncertainty, label
 
 
 if __name__ == '__main__':
+    random.seed('KMU_AELAB')
+    torch.manual_seed(0)
+    torch.backends.cudnn.deterministic = DETERMINISTIC
+
+    data_train, data_unlabeled, data_test = build_datasets()
+
+    train_sampler = SubsetRandomSampler([])
+    unlabeled_sampler = SubsetSequentialSampler([])
+
+    train_loader = DataLoader(data_train, batch_size=BATCH,
+                              sampler=train_sampler, drop_last=True, **LOADER_KWARGS)
+    test_loader = DataLoader(data_test, batch_size=BATCH, **LOADER_KWARGS)
+    unlabeled_loader = DataLoader(data_unlabeled, batch_size=BATCH,
+                                  sampler=unlabeled_sampler, **LOADER_KWARGS)
+    dataloaders = {'train': train_loader, 'test': test_loader}
+
+    torch._inductor.config.triton.cudagraph_skip_dynamic_graphs = True
+
     for trial in range(TRIALS):
         fp = open(f'record_{trial + 1}.txt', 'w')
 
@@ -155,26 +171,25 @@ if __name__ == '__main__':
         random.shuffle(indices)
         labeled_set = indices[:INIT_CNT]
         unlabeled_set = indices[INIT_CNT:]
+        labeled_mask = np.zeros(NUM_TRAIN, dtype=bool)
 
-        train_loader = DataLoader(data_train, batch_size=BATCH,
-                                  sampler=SubsetRandomSampler(labeled_set),
-                                  pin_memory=True)
-        test_loader = DataLoader(data_test, batch_size=BATCH)
-        dataloaders = {'train': train_loader, 'test': test_loader}
+        train_sampler.indices = labeled_set
 
         loss_module = LossNet().cuda()
         resnet18 = ResNet18(num_classes=CLS_CNT).cuda()
         models = {'backbone': resnet18, 'module': loss_module}
+        for model in models.values():
+            model.compile(mode='reduce-overhead')
 
-        torch.backends.cudnn.benchmark = False
+        torch.backends.cudnn.benchmark = not DETERMINISTIC
 
-        for cycle in range(CYCLES):
-            criterion = nn.CrossEntropyLoss(reduction='none').cuda()
+        criterion = nn.CrossEntropyLoss(reduction='none').cuda()
 
+        for cycle in range(CYCLES):
             optim_backbone = optim.SGD(models['backbone'].parameters(), lr=LR,
-                                       momentum=MOMENTUM, weight_decay=WDECAY)
+                                       momentum=MOMENTUM, weight_decay=WDECAY, fused=True)
             optim_module = optim.SGD(models['module'].parameters(), lr=LR,
-                                     momentum=MOMENTUM, weight_decay=WDECAY)
+                                     momentum=MOMENTUM, weight_decay=WDECAY, fused=True)
             optimizers = {'backbone': optim_backbone, 'module': optim_module}
 
             sched_backbone = lr_scheduler.MultiStepLR(optim_backbone, milestones=MILESTONES)
@@ -189,31 +204,31 @@ if __name__ == '__main__':
                                                                                         CYCLES, len(labeled_set), acc))
 
             subset = unlabeled_set[:]
-            unlabeled_loader = DataLoader(data_unlabeled, batch_size=BATCH,
-                                          sampler=SubsetSequentialSampler(subset),
-                                          pin_memory=True)
+            unlabeled_sampler.indices = subset
 
             uncertainty, label = get_uncertainty(models, unlabeled_loader, criterion)
 
-            arg = np.argsort(uncertainty)
-            ordered_label = list(label[arg].numpy())[::-1]
-            ordered_index = list(torch.tensor(subset)[arg].numpy())[::-1]
+            # the per-class top-up below walks the whole ranking, so a full descending sort is kept on the GPU
+            arg = torch.argsort(uncertainty, descending=True)
+            ordered_label = label[arg]
+            ordered_index = torch.as_tensor(subset, device=arg.device)[arg]
 
-            labeled_set += ordered_index[:ADDENDUM - (MINIMUM_CNT * CLS_CNT)]
+            labeled_set += ordered_index[:ADDENDUM - (MINIMUM_CNT * CLS_CNT)].tolist()
             ordered_index = ordered_index[ADDENDUM - (MINIMUM_CNT * CLS_CNT):]
             ordered_label = ordered_label[ADDENDUM - (MINIMUM_CNT * CLS_CNT):]
 
-            cnt_lst = [0 for _ in range(CLS_CNT)]
-            for idx in range(len(ordered_index)):
-                if cnt_lst[ordered_label[idx]] < MINIMUM_CNT:
-                    cnt_lst[ordered_label[idx]] += 1
-                    labeled_set.append(ordered_index[idx])
-            unlabeled_set = list(set(unlabeled_set) - set(labeled_set))
+            # rank of each sample within its class, so the MINIMUM_CNT most uncertain per class are kept
+            order = torch.argsort(ordered_label, stable=True)
+            sorted_label = ordered_label[order]
+            rank = torch.empty_like(order)
+            rank[order] = torch.arange(len(order), device=order.device) - torch.searchsorted(sorted_label, sorted_label)
+            labeled_set += ordered_index[rank < MINIMUM_CNT].tolist()
+
+            labeled_mask[labeled_set] = True
+            unlabeled_set = np.flatnonzero(~labeled_mask).tolist()
 
             print(len(labeled_set), len(unlabeled_set))
 
-            dataloaders['train'] = DataLoader(data_train, batch_size=BATCH,
-                                              sampler=SubsetRandomSampler(labeled_set),
-                                              pin_memory=True)
+            train_sampler.indices = labeled_set
 
         fp.close()